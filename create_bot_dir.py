@@ -52,13 +52,15 @@ the botdir as login credentials for a matrix bot.
 import asyncio
 import getpass
 import json
+import logging
 import os
+import shutil
 import sys
+import tempfile
 import traceback
 from pathlib import Path
 from random import randint
-
-import aiofiles
+from typing import Optional
 
 from nio import (
     AsyncClient,
@@ -75,11 +77,17 @@ from nio import (
     UnknownToDeviceEvent,
 )
 
+try:
+    import orjson
+except ImportError:
+    # orjson is optional, the json module of the standard library is used instead
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
 ROOT_DIR = Path(__file__).parent.resolve()
-bot_dir_names = []
-for content in ROOT_DIR.iterdir():
-    if content.name.startswith("botdir_"):
-        bot_dir_names.append(content.name[7:])
+with os.scandir(ROOT_DIR) as entries:
+    bot_dir_names = [entry.name[7:] for entry in entries if entry.name.startswith("botdir_")]
 
 default_bot_name = bot_dir_names[0] if bot_dir_names else 'bot' + str(randint(1000, 9999))
 device_name = input(f"Choose a name for the bot device (default '{default_bot_name}'): ") or default_bot_name
@@ -90,248 +98,293 @@ BOT_DIR = Path(__file__).parent.resolve() / ("botdir_" + device_name)
 CONFIG_FILE = BOT_DIR / "login.json"
 # directory to store persistent data for end-to-end encryption
 STORE_PATH = BOT_DIR / "store"
+# parsed content of CONFIG_FILE, filled on first use by get_config()
+_CONFIG_CACHE: Optional[dict] = None
 
-if not BOT_DIR.exists():
-    print("Creating bot directory at the path: ", str(BOT_DIR))
-    BOT_DIR.mkdir()
-else:
-    print("Using the existing bot directory at the path: ", str(BOT_DIR))
-
-if not (BOT_DIR / "README.md").exists():
-    with open(BOT_DIR / "README.md", "w") as f:
-        with open(ROOT_DIR / "botdirinfo.md", "r") as f2:
-            f.write(f2.read())
+# the only verification method supported by this script
+_SAS_METHOD = 'm.sas.v1'
 
 
 class Callbacks:
     """Class to pass client to callback methods."""
 
     def __init__(self, client):
-        """Store AsyncClient."""
+        """Store AsyncClient and build the event dispatch tables."""
         self.client = client
+        # handlers for the events that nio parses into their own classes
+        self._dispatch = {
+            KeyVerificationStart: self._on_start,
+            KeyVerificationCancel: self._on_cancel,
+            KeyVerificationKey: self._on_key,
+            KeyVerificationMac: self._on_mac,
+        }
+        # handlers for the events that nio only knows as UnknownToDeviceEvent
+        self._source_dispatch = {
+            'm.key.verification.request': self._on_request,
+            'm.key.verification.done': self._on_done,
+        }
 
     async def to_device_callback(self, event):  # noqa
         """Handle events sent to device."""
         try:
-            client = self.client
-
-            if event.source['type'] == 'm.key.verification.request':
-                """First step in new flow: receive a request proposing
-                a set of verification methods, and in this case respond
-                saying we only support SAS verification.
-                """
-                print(
-                    "Got verification request. "
-                    "Waiting for other device to accept SAS method..."
-                )
-                if 'm.sas.v1' not in event.source['content']['methods']:
-                    print(
-                        "Other device does not support SAS authentication. "
-                        f"Methods: {event.source['content']['methods']}."
-                    )
-                    return
-                assert client.device_id is not None
-                assert client.user_id is not None
-                txid = event.source['content']['transaction_id']
-                ready_event = ToDeviceMessage(
-                    type                = 'm.key.verification.ready',
-                    recipient           = event.sender,
-                    recipient_device    = event.source['content']['from_device'],
-                    content             = {
-                        'from_device': client.device_id,
-                        'methods': ['m.sas.v1'],
-                        'transaction_id': txid,
-                    },
-                )
-                resp = await client.to_device(ready_event, txid)
-                if isinstance(resp, ToDeviceError):
-                    print(f"to_device failed with {resp}")
-            elif isinstance(event, KeyVerificationStart):  # first step
-                """first step: receive KeyVerificationStart
-                KeyVerificationStart(
-                    source={'content':
-                            {'method': 'm.sas.v1',
-                             'from_device': 'DEVICEIDXY',
-                             'key_agreement_protocols':
-                                ['curve25519-hkdf-sha256', 'curve25519'],
-                             'hashes': ['sha256'],
-                             'message_authentication_codes':
-                                ['hkdf-hmac-sha256', 'hmac-sha256'],
-                             'short_authentication_string':
-                                ['decimal', 'emoji'],
-                             'transaction_id': 'SomeTxId'
-                             },
-                            'type': 'm.key.verification.start',
-                            'sender': '@user2:example.org'
-                            },
-                    sender='@user2:example.org',
-                    transaction_id='SomeTxId',
-                    from_device='DEVICEIDXY',
-                    method='m.sas.v1',
-                    key_agreement_protocols=[
-                        'curve25519-hkdf-sha256', 'curve25519'],
-                    hashes=['sha256'],
-                    message_authentication_codes=[
-                        'hkdf-hmac-sha256', 'hmac-sha256'],
-                    short_authentication_string=['decimal', 'emoji'])
-                """
-
-                if "emoji" not in event.short_authentication_string:
-                    print(
-                        "Other device does not support emoji verification "
-                        f"{event.short_authentication_string}."
-                    )
-                    return
-                resp = await client.accept_key_verification(event.transaction_id)
-                if isinstance(resp, ToDeviceError):
-                    print(f"accept_key_verification failed with {resp}")
-
-                sas = client.key_verifications[event.transaction_id]
-
-                todevice_msg = sas.share_key()
-                resp = await client.to_device(todevice_msg)
-                if isinstance(resp, ToDeviceError):
-                    print(f"to_device failed with {resp}")
-
-            elif isinstance(event, KeyVerificationCancel):  # anytime
-                """at any time: receive KeyVerificationCancel
-                KeyVerificationCancel(source={
-                    'content': {'code': 'm.mismatched_sas',
-                                'reason': 'Mismatched authentication string',
-                                'transaction_id': 'SomeTxId'},
-                    'type': 'm.key.verification.cancel',
-                    'sender': '@user2:example.org'},
-                    sender='@user2:example.org',
-                    transaction_id='SomeTxId',
-                    code='m.mismatched_sas',
-                    reason='Mismatched short authentication string')
-                """
-
-                # There is no need to issue a
-                # client.cancel_key_verification(tx_id, reject=False)
-                # here. The SAS flow is already cancelled.
-                # We only need to inform the user.
-                print(
-                    f"Verification has been cancelled by {event.sender} "
-                    f'for reason "{event.reason}".'
-                )
-
-            elif isinstance(event, KeyVerificationKey):  # second step
-                """Second step is to receive KeyVerificationKey
-                KeyVerificationKey(
-                    source={'content': {
-                            'key': 'SomeCryptoKey',
-                            'transaction_id': 'SomeTxId'},
-                        'type': 'm.key.verification.key',
-                        'sender': '@user2:example.org'
-                    },
-                    sender='@user2:example.org',
-                    transaction_id='SomeTxId',
-                    key='SomeCryptoKey')
-                """
-                sas = client.key_verifications[event.transaction_id]
-
-                print(f"{sas.get_emoji()}")
-
-                yn = input("Do the emojis match? (Y/N) (C for Cancel) - verify them on the other device first:")
-                if yn.lower() == "y":
-                    print(
-                        "Match! The verification for this " "device will be accepted."
-                    )
-                    resp = await client.confirm_short_auth_string(event.transaction_id)
-                    if isinstance(resp, ToDeviceError):
-                        print(f"confirm_short_auth_string failed with {resp}")
-
-                    # Extra step in new flow: once we have completed the SAS
-                    # verification successfully, send a 'done' to-device event
-                    # to the other device to assert that the verification was
-                    # successful.
-                    done_message = ToDeviceMessage(
-                        type                = 'm.key.verification.done',
-                        recipient           = event.sender,
-                        recipient_device    = sas.other_olm_device.device_id,
-                        content             = {
-                            'transaction_id': sas.transaction_id,
-                        },
-                    )
-                    resp = await client.to_device(done_message, sas.transaction_id)
-                    if isinstance(resp, ToDeviceError):
-                        client.log.error(f"'done' failed with {resp}")
-
-                elif yn.lower() == "n":  # no, don't match, reject
-                    print(
-                        "No match! Device will NOT be verified "
-                        "by rejecting verification."
-                    )
-                    resp = await client.cancel_key_verification(
-                        event.transaction_id, reject=True
-                    )
-                    if isinstance(resp, ToDeviceError):
-                        print(f"cancel_key_verification failed with {resp}")
-                else:  # C or anything for cancel
-                    print("Cancelled by user! Verification will be " "cancelled.")
-                    resp = await client.cancel_key_verification(
-                        event.transaction_id, reject=False
-                    )
-                    if isinstance(resp, ToDeviceError):
-                        print(f"cancel_key_verification failed with {resp}")
-
-            elif isinstance(event, KeyVerificationMac):  # third step
-                """Third step is to receive KeyVerificationMac
-                KeyVerificationMac(
-                    source={'content': {
-                        'mac': {'ed25519:DEVICEIDXY': 'SomeKey1',
-                                'ed25519:SomeKey2': 'SomeKey3'},
-                        'keys': 'SomeCryptoKey4',
-                        'transaction_id': 'SomeTxId'},
-                        'type': 'm.key.verification.mac',
-                        'sender': '@user2:example.org'},
-                    sender='@user2:example.org',
-                    transaction_id='SomeTxId',
-                    mac={'ed25519:DEVICEIDXY': 'SomeKey1',
-                         'ed25519:SomeKey2': 'SomeKey3'},
-                    keys='SomeCryptoKey4')
-                """
-                sas = client.key_verifications[event.transaction_id]
-                try:
-                    todevice_msg = sas.get_mac()
-                except LocalProtocolError as e:
-                    # e.g. it might have been cancelled by ourselves
-                    print(
-                        f"Cancelled or protocol error: Reason: {e}.\n"
-                        f"Verification with {event.sender} not concluded. "
-                        "Try again?"
-                    )
-                else:
-                    resp = await client.to_device(todevice_msg)
-                    if isinstance(resp, ToDeviceError):
-                        print(f"to_device failed with {resp}")
-            elif event.source['type'] == 'm.key.verification.done':
-                # Final step, other device acknowledges verification success.
-                txid = event.source['content']['transaction_id']
-                sas = client.key_verifications[txid]
-
-                print(
-                    f"sas.we_started_it = {sas.we_started_it}\n"
-                    f"sas.sas_accepted = {sas.sas_accepted}\n"
-                    f"sas.canceled = {sas.canceled}\n"
-                    f"sas.timed_out = {sas.timed_out}\n"
-                    f"sas.verified = {sas.verified}\n"
-                    f"sas.verified_devices = {sas.verified_devices}\n"
-                )
-                print(
-                    "Emoji verification was successful!\n"
-                    "Hit Control-C to stop the program or "
-                    "initiate another Emoji verification from "
-                    "another device or room."
-                )
+            handler = (
+                self._source_dispatch.get(event.source['type'])
+                or self._dispatch.get(type(event))
+            )
+            if handler:
+                # resolve the transaction and its SAS state once for every handler,
+                # the SAS is None until nio tracks the transaction, so handlers
+                # that need it check it with _is_tracked() first
+                txid = getattr(event, 'transaction_id', None)
+                if txid is None:
+                    txid = event.source['content']['transaction_id']
+                sas = self.client.key_verifications.get(txid)
+                await handler(event, txid, sas)
             else:
                 print(
                     f"Received unexpected event type {type(event)}. "
                     f"Event is {event}. Event will be ignored."
                 )
-        except BaseException:
-            print(traceback.format_exc())
+        except Exception:
+            logger.exception("to_device callback failed")
+
+    def _is_tracked(self, txid, sas):
+        """Check that nio tracks the SAS of a verification transaction."""
+        if sas is None:
+            print(
+                f"No verification in progress for transaction {txid}. "
+                "Event will be ignored."
+            )
+            return False
+        return True
+
+    async def _on_request(self, event, txid, sas):
+        """First step in new flow: receive a request proposing
+        a set of verification methods, and in this case respond
+        saying we only support SAS verification.
+        """
+        client = self.client
+        print(
+            "Got verification request. "
+            "Waiting for other device to accept SAS method..."
+        )
+        content = event.source['content']
+        methods = content['methods']
+        if _SAS_METHOD not in methods:
+            print(
+                "Other device does not support SAS authentication. "
+                f"Methods: {methods}."
+            )
+            return
+        assert client.device_id is not None
+        assert client.user_id is not None
+        ready_event = ToDeviceMessage(
+            type                = 'm.key.verification.ready',
+            recipient           = event.sender,
+            recipient_device    = content['from_device'],
+            content             = {
+                'from_device': client.device_id,
+                'methods': [_SAS_METHOD],
+                'transaction_id': txid,
+            },
+        )
+        resp = await client.to_device(ready_event, txid)
+        if isinstance(resp, ToDeviceError):
+            print(f"to_device failed with {resp}")
+
+    async def _on_start(self, event, txid, sas):  # first step
+        """first step: receive KeyVerificationStart
+        KeyVerificationStart(
+            source={'content':
+                    {'method': 'm.sas.v1',
+                     'from_device': 'DEVICEIDXY',
+                     'key_agreement_protocols':
+                        ['curve25519-hkdf-sha256', 'curve25519'],
+                     'hashes': ['sha256'],
+                     'message_authentication_codes':
+                        ['hkdf-hmac-sha256', 'hmac-sha256'],
+                     'short_authentication_string':
+                        ['decimal', 'emoji'],
+                     'transaction_id': 'SomeTxId'
+                     },
+                    'type': 'm.key.verification.start',
+                    'sender': '@user2:example.org'
+                    },
+            sender='@user2:example.org',
+            transaction_id='SomeTxId',
+            from_device='DEVICEIDXY',
+            method='m.sas.v1',
+            key_agreement_protocols=[
+                'curve25519-hkdf-sha256', 'curve25519'],
+            hashes=['sha256'],
+            message_authentication_codes=[
+                'hkdf-hmac-sha256', 'hmac-sha256'],
+            short_authentication_string=['decimal', 'emoji'])
+        """
+        client = self.client
+        if not self._is_tracked(txid, sas):
+            return
+
+        if "emoji" not in event.short_authentication_string:
+            print(
+                "Other device does not support emoji verification "
+                f"{event.short_authentication_string}."
+            )
+            return
+        resp = await client.accept_key_verification(txid)
+        if isinstance(resp, ToDeviceError):
+            print(f"accept_key_verification failed with {resp}")
+
+        todevice_msg = sas.share_key()
+        resp = await client.to_device(todevice_msg)
+        if isinstance(resp, ToDeviceError):
+            print(f"to_device failed with {resp}")
+
+    async def _on_cancel(self, event, txid, sas):  # anytime
+        """at any time: receive KeyVerificationCancel
+        KeyVerificationCancel(source={
+            'content': {'code': 'm.mismatched_sas',
+                        'reason': 'Mismatched authentication string',
+                        'transaction_id': 'SomeTxId'},
+            'type': 'm.key.verification.cancel',
+            'sender': '@user2:example.org'},
+            sender='@user2:example.org',
+            transaction_id='SomeTxId',
+            code='m.mismatched_sas',
+            reason='Mismatched short authentication string')
+        """
+
+        # There is no need to issue a
+        # client.cancel_key_verification(tx_id, reject=False)
+        # here. The SAS flow is already cancelled.
+        # We only need to inform the user.
+        print(
+            f"Verification has been cancelled by {event.sender} "
+            f'for reason "{event.reason}".'
+        )
+
+    async def _on_key(self, event, txid, sas):  # second step
+        """Second step is to receive KeyVerificationKey
+        KeyVerificationKey(
+            source={'content': {
+                    'key': 'SomeCryptoKey',
+                    'transaction_id': 'SomeTxId'},
+                'type': 'm.key.verification.key',
+                'sender': '@user2:example.org'
+            },
+            sender='@user2:example.org',
+            transaction_id='SomeTxId',
+            key='SomeCryptoKey')
+        """
+        client = self.client
+        if not self._is_tracked(txid, sas):
+            return
+
+        print(f"{sas.get_emoji()}")
+
+        yn = input("Do the emojis match? (Y/N) (C for Cancel) - verify them on the other device first:")
+        if yn.lower() == "y":
+            print(
+                "Match! The verification for this " "device will be accepted."
+            )
+            resp = await client.confirm_short_auth_string(txid)
+            if isinstance(resp, ToDeviceError):
+                print(f"confirm_short_auth_string failed with {resp}")
+
+            # Extra step in new flow: once we have completed the SAS
+            # verification successfully, send a 'done' to-device event
+            # to the other device to assert that the verification was
+            # successful.
+            done_message = ToDeviceMessage(
+                type                = 'm.key.verification.done',
+                recipient           = event.sender,
+                recipient_device    = sas.other_olm_device.device_id,
+                content             = {
+                    'transaction_id': sas.transaction_id,
+                },
+            )
+            resp = await client.to_device(done_message, sas.transaction_id)
+            if isinstance(resp, ToDeviceError):
+                logger.error(f"'done' failed with {resp}")
+
+        elif yn.lower() == "n":  # no, don't match, reject
+            print(
+                "No match! Device will NOT be verified "
+                "by rejecting verification."
+            )
+            resp = await client.cancel_key_verification(
+                txid, reject=True
+            )
+            if isinstance(resp, ToDeviceError):
+                print(f"cancel_key_verification failed with {resp}")
+        else:  # C or anything for cancel
+            print("Cancelled by user! Verification will be " "cancelled.")
+            resp = await client.cancel_key_verification(
+                txid, reject=False
+            )
+            if isinstance(resp, ToDeviceError):
+                print(f"cancel_key_verification failed with {resp}")
+
+    async def _on_mac(self, event, txid, sas):  # third step
+        """Third step is to receive KeyVerificationMac
+        KeyVerificationMac(
+            source={'content': {
+                'mac': {'ed25519:DEVICEIDXY': 'SomeKey1',
+                        'ed25519:SomeKey2': 'SomeKey3'},
+                'keys': 'SomeCryptoKey4',
+                'transaction_id': 'SomeTxId'},
+                'type': 'm.key.verification.mac',
+                'sender': '@user2:example.org'},
+            sender='@user2:example.org',
+            transaction_id='SomeTxId',
+            mac={'ed25519:DEVICEIDXY': 'SomeKey1',
+                 'ed25519:SomeKey2': 'SomeKey3'},
+            keys='SomeCryptoKey4')
+        """
+        client = self.client
+        if not self._is_tracked(txid, sas):
+            return
+        try:
+            todevice_msg = sas.get_mac()
+        except LocalProtocolError as e:
+            # e.g. it might have been cancelled by ourselves
+            print(
+                f"Cancelled or protocol error: Reason: {e}.\n"
+                f"Verification with {event.sender} not concluded. "
+                "Try again?"
+            )
+        else:
+            resp = await client.to_device(todevice_msg)
+            if isinstance(resp, ToDeviceError):
+                print(f"to_device failed with {resp}")
+
+    async def _on_done(self, event, txid, sas):
+        """Final step, other device acknowledges verification success."""
+        if not self._is_tracked(txid, sas):
+            return
+        print(
+            f"sas.we_started_it = {sas.we_started_it}\n"
+            f"sas.sas_accepted = {sas.sas_accepted}\n"
+            f"sas.canceled = {sas.canceled}\n"
+            f"sas.timed_out = {sas.timed_out}\n"
+            f"sas.verified = {sas.verified}\n"
+            f"sas.verified_devices = {sas.verified_devices}\n"
+        )
+        print(
+            "Emoji verification was successful!\n"
+            "Hit Control-C to stop the program or "
+            "initiate another Emoji verification from "
+            "another device or room."
+        )
+
+
+def get_config() -> dict:
+    """Return the stored login details, reading CONFIG_FILE only once."""
+    global _CONFIG_CACHE
+    if _CONFIG_CACHE is None:
+        # both parsers accept the raw bytes of the file
+        _CONFIG_CACHE = (orjson or json).loads(CONFIG_FILE.read_bytes())
+    return _CONFIG_CACHE
 
 
 def write_details_to_disk(resp: LoginResponse, homeserver, device_name) -> None:
@@ -345,19 +398,30 @@ def write_details_to_disk(resp: LoginResponse, homeserver, device_name) -> None:
         homeserver : str - URL of homeserver, e.g. "https://matrix.example.org"
 
     """
-    # open the config file in write-mode
-    with open(str(CONFIG_FILE), "w") as f:
-        # write the login details to disk
-        json.dump(
-            {
-                "homeserver": homeserver,  # e.g. "https://matrix.example.org"
-                "user_id": resp.user_id,  # e.g. "@user:example.org"
-                "device_id": resp.device_id,  # device ID, 10 uppercase letters
-                "access_token": resp.access_token,  # cryptogr. access token
-                "device_name": device_name,  # e.g. "matrix-nio"
-            },
-            f,
-        )
+    global _CONFIG_CACHE
+    # the cached details are stale once the file is rewritten
+    _CONFIG_CACHE = None
+    details = {
+        "homeserver": homeserver,  # e.g. "https://matrix.example.org"
+        "user_id": resp.user_id,  # e.g. "@user:example.org"
+        "device_id": resp.device_id,  # device ID, 10 uppercase letters
+        "access_token": resp.access_token,  # cryptogr. access token
+        "device_name": device_name,  # e.g. "matrix-nio"
+    }
+    data = orjson.dumps(details) if orjson else json.dumps(details).encode()
+    # write the login details to a temporary file in the bot directory and
+    # rename it over the config file, so a crash never leaves a truncated file
+    fd, tmp = tempfile.mkstemp(dir=BOT_DIR, prefix="login.json.", suffix=".tmp")
+    try:
+        # the buffered file object keeps writing until all bytes are written
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, CONFIG_FILE)
+    except BaseException:
+        os.unlink(tmp)
+        raise
 
 
 async def login() -> AsyncClient:
@@ -385,9 +449,6 @@ async def login() -> AsyncClient:
         user_id = "@user:example.org"
         user_id = input(f"Enter your full user ID: [{user_id}] ")
 
-        if not STORE_PATH.exists():
-            STORE_PATH.mkdir()
-
         # Initialize the matrix client
         client = AsyncClient(
             homeserver,
@@ -414,10 +475,7 @@ async def login() -> AsyncClient:
 
     # Otherwise the config file exists, so we'll use the stored credentials
     else:
-        # open the file in read-only mode
-        async with aiofiles.open(str(CONFIG_FILE), "r") as f:
-            contents = await f.read()
-        config = json.loads(contents)
+        config = get_config()
         # Initialize the matrix client based on credentials from file
         client = AsyncClient(
             config["homeserver"],
@@ -437,8 +495,28 @@ async def login() -> AsyncClient:
     return client
 
 
+async def prepare_dirs() -> None:
+    """Create the bot directory together with its README and store."""
+    if os.path.isdir(BOT_DIR):
+        print("Using the existing bot directory at the path: ", str(BOT_DIR))
+    else:
+        print("Creating bot directory at the path: ", str(BOT_DIR))
+    await asyncio.to_thread(BOT_DIR.mkdir, exist_ok=True)
+
+    # The README copy and the store creation are independent of each other,
+    # so both are started before either is awaited.
+    tasks = []
+    if not (BOT_DIR / "README.md").exists():
+        tasks.append(asyncio.create_task(
+            asyncio.to_thread(shutil.copyfile, ROOT_DIR / "botdirinfo.md", BOT_DIR / "README.md")
+        ))
+    tasks.append(asyncio.create_task(asyncio.to_thread(STORE_PATH.mkdir, parents=True, exist_ok=True)))
+    await asyncio.gather(*tasks)
+
+
 async def main() -> None:
     """Login and wait for and perform emoji verify."""
+    await prepare_dirs()
     client = await login()
     # Set up event callbacks
     callbacks = Callbacks(client)
@@ -456,7 +534,15 @@ async def main() -> None:
 
 
 try:
-    asyncio.run(main())
+    import uvloop
+except ImportError:
+    # uvloop is optional, fall back to the default asyncio event loop
+    run = asyncio.run
+else:
+    run = uvloop.run
+
+try:
+    run(main())
 except Exception:
     print(traceback.format_exc())
     sys.exit(1)